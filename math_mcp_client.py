@@ -1,20 +1,253 @@
 import asyncio
 import argparse
+import functools
+import hashlib
+import importlib.util
 import json
+import logging
 import os
+import re
+import sqlite3
 import sys
+import types
+from collections import OrderedDict
+from contextlib import AsyncExitStack
 
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
+from mcp.types import CallToolResult, TextContent
 
+try:
+    import httpx
+    from openai import AsyncOpenAI  # type: ignore
+except ImportError:  # pragma: no cover
+    AsyncOpenAI = None
 
+try:
+    import h2  # type: ignore  # noqa: F401
+except ImportError:  # pragma: no cover
+    h2 = None
+
+try:
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+# orjson parses the small routing payloads several times faster than the
+# stdlib; both variants raise json.JSONDecodeError on bad input.
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps_bytes(obj) -> bytes:
+        return orjson.dumps(obj)
+else:  # pragma: no cover
+    json_loads = json.loads
+
+    def json_dumps_bytes(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = ("add", "subtract", "multiply", "divide")
+
+# Prompts and strict function schemas are built once at import; the schema
+# guarantees operation/a/b are present, so the prompt only covers semantics.
+_ROUTE_SYSTEM_PROMPT = (
+    "Route the math question to one operation and its two operands. "
+    "For 'subtract X from Y' use a=Y, b=X. Keep numbers as given, even for division by zero."
+)
+
+_ROUTE_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "route",
+        "strict": True,
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "operation": {"type": "string", "enum": list(OPERATIONS)},
+                "a": {"type": "number"},
+                "b": {"type": "number"},
+            },
+            "required": ["operation", "a", "b"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+_ROUTE_STEPS_SYSTEM_PROMPT = (
+    "Split the math question into steps of one operation on two operands. "
+    "To use an earlier step's result as an operand, set a_step or b_step to that step's "
+    "0-based index and the operand to null; otherwise set the step index to null. "
+    "For 'subtract X from Y' use a=Y, b=X."
+)
+
+_ROUTE_STEPS_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "route_steps",
+        "strict": True,
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "steps": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "operation": {"type": "string", "enum": list(OPERATIONS)},
+                            "a": {"type": ["number", "null"]},
+                            "b": {"type": ["number", "null"]},
+                            "a_step": {"type": ["integer", "null"]},
+                            "b_step": {"type": ["integer", "null"]},
+                        },
+                        "required": ["operation", "a", "b", "a_step", "b_step"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["steps"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+_ROUTE_MANY_SYSTEM_PROMPT = (
+    "Route each numbered math question to one operation and its two operands, "
+    "returning one route per question with the question's number as index. "
+    "For 'subtract X from Y' use a=Y, b=X. Keep numbers as given, even for division by zero."
+)
+
+_ROUTE_MANY_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "route_many",
+        "strict": True,
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "routes": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "index": {"type": "integer"},
+                            "operation": {"type": "string", "enum": list(OPERATIONS)},
+                            "a": {"type": "number"},
+                            "b": {"type": "number"},
+                        },
+                        "required": ["index", "operation", "a", "b"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["routes"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Questions per combined routing request; bigger chunks share the system
+# prompt further but risk truncated or misaligned answers.
+ROUTE_BATCH_SIZE = 20
+
+ROUTE_MEMO_SIZE = 1024
+
+_ROUTE_MEMO: OrderedDict[tuple[str, str], tuple[str, float, float]] = OrderedDict()
+
+_IN_FLIGHT_ROUTES: dict[tuple[str, str], asyncio.Future] = {}
+
+# A signed integer or decimal, including leading-dot forms such as ".5"
+_NUMBER = r"[-+]?(?:\d+(?:\.\d+)?|\.\d+)"
+
+# Standalone numbers only: "0x10", "3rd" or "1.2.3" contain no usable operand,
+# while a sentence-ending "4." still counts.
+_NUMBER_RE = re.compile(rf"(?<![\w.]){_NUMBER}(?!\w|\.\d)")
+
+# Natural-language fast paths must cover the whole question: an optional lead-in
+# and closing punctuation only, so "3 plus 4 squared" still goes to the LLM.
+_QUESTION_PREFIX = r"^\s*(?:(?:what(?:'s|\s+is)|please|calculate|compute)\s+)?"
+_QUESTION_SUFFIX = r"\s*[?!.]?\s*$"
+
+# Machine-style directives such as "add 2 3" or "math.divide 1 8"
+_DIRECTIVE_RE = re.compile(rf"^\s*(?:math\.)?(\w+)\s+({_NUMBER})\s+({_NUMBER})\s*$", re.IGNORECASE)
+
+# "<number> <operator word> <number>", e.g. "what is 3 plus 4" or "12 divided by 5"
+_INFIX_ROUTE_RE = re.compile(
+    rf"{_QUESTION_PREFIX}({_NUMBER})\s*(plus|minus|times|multiplied by|divided by|over|subtracted from)\s*({_NUMBER})"
+    rf"{_QUESTION_SUFFIX}",
+    re.IGNORECASE,
+)
+
+# Bare arithmetic such as "3+4", "what is 7 x 8?" or "10 ÷ 4"; the letter x
+# needs spaces around it so "0x10" is not read as 0 times 10.
+_SYMBOL_ROUTE_RE = re.compile(
+    rf"^\s*(?:what(?:'s|\s+is)\s+)?({_NUMBER})(\s*[-+*×/÷]\s*|\s+x\s+)({_NUMBER})\s*[?=]?\s*$",
+    re.IGNORECASE,
+)
+
+_OPERATOR_SYMBOLS = {
+    "+": "add",
+    "-": "subtract",
+    "*": "multiply",
+    "x": "multiply",
+    "×": "multiply",
+    "/": "divide",
+    "÷": "divide",
+}
+
+# "<verb> <number> <preposition> <number>", e.g. "subtract 3 from 10" or "divide 9 by 3"
+_VERB_ROUTE_RE = re.compile(
+    rf"{_QUESTION_PREFIX}(add|subtract|multiply|divide)\s+({_NUMBER})\s+(and|to|from|by)\s+({_NUMBER}){_QUESTION_SUFFIX}",
+    re.IGNORECASE,
+)
+
+_VERB_PREPOSITIONS = {
+    "add": ("and", "to"),
+    "subtract": ("from",),
+    "multiply": ("and", "by"),
+    "divide": ("by",),
+}
+
+# Words that fix which number is the first operand regardless of the values
+_ORDER_WORD_RE = re.compile(r"\b(?:from|by)\b")
+
+ROUTE_CACHE_PATH = os.getenv(
+    "MATH_MCP_ROUTE_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "math_mcp", "routes.sqlite"),
+)
+
+
+@functools.lru_cache(maxsize=1)
 def get_server_script_path() -> str:
+    # Checked once; only a successful lookup is cached
     current_dir = os.path.dirname(os.path.abspath(__file__))
-    return os.path.join(current_dir, "math_mcp_server.py")
+    server_script = os.path.join(current_dir, "math_mcp_server.py")
+    if not os.path.exists(server_script):
+        raise FileNotFoundError(f"Server script not found at: {server_script}")
+    return server_script
+
+
+def default_server_params() -> StdioServerParameters:
+    return StdioServerParameters(
+        command=sys.executable,
+        args=[get_server_script_path()],
+        env=None,
+    )
+
+
+async def print_progress(progress: float, total: float | None, message: str | None) -> None:
+    # Progress goes to stderr so stdout stays one result per line
+    done = f"{progress / total:.0%}" if total else f"{progress:g}"
+    print(f"[progress] {done} {message or ''}".rstrip(), file=sys.stderr)
 
 
 async def call_tool(session: ClientSession, name: str, **arguments) -> str:
-    result = await session.call_tool(name=name, arguments=arguments)
+    # Servers that report progress on long-running tools stream it through
+    # print_progress while the call is awaited alongside other tool calls.
+    result = await session.call_tool(name=name, arguments=arguments, progress_callback=print_progress)
 
     # Try to extract human-readable text from the result's content items
     try:
@@ -28,113 +261,752 @@ async def call_tool(session: ClientSession, name: str, **arguments) -> str:
     except Exception:
         return str(result)
 
-def normalize_operation(op: str | None) -> str | None:
-    if op is None:
-        return None
-    mapping = {
+_OPERATION_SYNONYMS = types.MappingProxyType({
+    sys.intern(word): sys.intern(operation)
+    for word, operation in {
         "add": "add",
+        "added": "add",
         "plus": "add",
         "sum": "add",
         "total": "add",
         "subtract": "subtract",
+        "subtracted": "subtract",
         "minus": "subtract",
         "difference": "subtract",
         "multiply": "multiply",
+        "multiplied": "multiply",
         "times": "multiply",
         "product": "multiply",
         "divide": "divide",
+        "divided": "divide",
         "quotient": "divide",
         "over": "divide",
-    }
-    return mapping.get(op.lower(), op.lower())
+    }.items()
+})
+
+
+@functools.lru_cache(maxsize=512)
+def normalize_operation(op: str | None) -> str | None:
+    if op is None:
+        return None
+    op = op.lower()
+    if op in _OPERATION_SYNONYMS:
+        return _OPERATION_SYNONYMS[op]
+    # Multi-word variants such as "divided by" or "multiplied_by" resolve via
+    # their first recognised word.
+    for token in re.split(r"[\s_]+", op):
+        if token in _OPERATION_SYNONYMS:
+            return _OPERATION_SYNONYMS[token]
+    return op
+
 
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+
+@functools.lru_cache(maxsize=1)
 def ensure_openai_client():
+    # Cached so the SDK client and its connection pool are built once per
+    # process; a missing key raises and is not cached.
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise RuntimeError("OPENAI_API_KEY is not set. Export OPENAI_API_KEY.")
-    try:
-        from openai import OpenAI  # type: ignore
-    except Exception as exc:  # pragma: no cover
+    if AsyncOpenAI is None:  # pragma: no cover
         raise RuntimeError(
             "OpenAI SDK not installed. Install 'openai' or run 'pip install -r requirements.txt'."
-        ) from exc
-    return OpenAI()
+        )
+
+    # One keep-alive connection pool for the life of the process, so repeated
+    # routing calls (REPL, questions file) skip the TCP + TLS handshake. The
+    # pool is sized for a fully concurrent questions file, and requests beyond
+    # it wait for a free connection instead of failing with a pool timeout.
+    http_client = httpx.AsyncClient(
+        http2=h2 is not None,
+        timeout=httpx.Timeout(30.0, connect=5.0, pool=None),
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+        ),
+    )
+    # The SDK retries 408/409/429/5xx and connection errors with exponential
+    # backoff and jitter; give rate-limited routing a few more attempts.
+    return AsyncOpenAI(http_client=http_client, max_retries=OPENAI_MAX_RETRIES)
+
+
+def normalize_question(question: str) -> str:
+    # "What is 3 plus 4?" and "what is  3 plus 4" share cache entries
+    return re.sub(r"\s+", " ", question).strip().lower().rstrip("?!. ")
+
+
+async def prewarm_openai() -> None:
+    # A cheap authenticated request opens the TCP + TLS connection so the
+    # first real routing call reuses it from the pool.
+    try:
+        await ensure_openai_client().models.list()
+    except Exception:
+        pass
+
+
+def route_cache_key(question: str, model: str) -> str:
+    return hashlib.sha1(f"{model}|{normalize_question(question)}".encode()).hexdigest()
+
+
+def _memo_get(key: tuple[str, str]) -> tuple[str, float, float] | None:
+    route = _ROUTE_MEMO.get(key)
+    if route is not None:
+        _ROUTE_MEMO.move_to_end(key)
+    return route
+
+
+def _memo_put(key: tuple[str, str], route: tuple[str, float, float]) -> None:
+    _ROUTE_MEMO[key] = route
+    _ROUTE_MEMO.move_to_end(key)
+    if len(_ROUTE_MEMO) > ROUTE_MEMO_SIZE:
+        _ROUTE_MEMO.popitem(last=False)
+
+
+@functools.lru_cache(maxsize=1)
+def _open_route_cache() -> sqlite3.Connection | None:
+    # Opened once per process with the schema created up front; lookups and
+    # stores reuse the connection. An empty MATH_MCP_ROUTE_CACHE disables the
+    # on-disk cache, and a cache that cannot be opened stays disabled.
+    if not ROUTE_CACHE_PATH:
+        return None
+    try:
+        os.makedirs(os.path.dirname(ROUTE_CACHE_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(ROUTE_CACHE_PATH)
+        conn.execute("CREATE TABLE IF NOT EXISTS routes (key TEXT PRIMARY KEY, route TEXT NOT NULL)")
+        return conn
+    except (OSError, sqlite3.Error):
+        return None
+
+
+def route_cache_get(key: str) -> list | None:
+    conn = _open_route_cache()
+    if conn is None:
+        return None
+    try:
+        row = conn.execute("SELECT route FROM routes WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error:
+        return None
+    return json_loads(row[0]) if row is not None else None
+
+
+def route_cache_put(key: str, route: list | tuple) -> None:
+    conn = _open_route_cache()
+    if conn is None:
+        return
+    try:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO routes (key, route) VALUES (?, ?)", (key, json_dumps_bytes(route).decode()))
+    except sqlite3.Error:
+        pass
+
+
+def question_template(question: str) -> tuple[str, list[float]]:
+    # 'what is 3 plus 4' -> ('what is <N> plus <N>', [3.0, 4.0])
+    slots = [float(m) for m in _NUMBER_RE.findall(question)]
+    template = _NUMBER_RE.sub("<N>", normalize_question(question))
+    return template, slots
+
+
+def template_route(op: str, a: float, b: float, template: str, slots: list[float]) -> list | None:
+    # Only cache when each operand maps back to exactly one number in the
+    # question; anything else (repeated or derived values) could be refilled
+    # incorrectly for a different set of numbers.
+    if len(set(slots)) != len(slots) or a not in slots or b not in slots:
+        return None
+    # Operand order for subtract and divide is only trusted when the wording
+    # fixes it ("subtract 3 from 10", "divide 9 by 3"); for "the difference
+    # between 3 and 10" the model may have ordered the operands by value, in
+    # either direction, so those stay under their exact-question key.
+    if op in {"subtract", "divide"} and _ORDER_WORD_RE.search(template) is None:
+        return None
+    return [op, slots.index(a), slots.index(b)]
+
+
+def directive_route(question: str) -> tuple[str, float, float] | None:
+    match = _DIRECTIVE_RE.match(question)
+    if match is None:
+        return None
+    op = normalize_operation(match.group(1))
+    if op not in OPERATIONS:
+        return None
+    return op, float(match.group(2)), float(match.group(3))
+
+
+def regex_route(question: str) -> tuple[str, float, float] | None:
+    # Only questions with exactly two numbers are safe to route locally;
+    # "3 plus 4 times 2" still goes to the LLM.
+    if len(_NUMBER_RE.findall(question)) != 2:
+        return None
+
+    match = _SYMBOL_ROUTE_RE.match(question)
+    if match is not None:
+        return _OPERATOR_SYMBOLS[match.group(2).strip().lower()], float(match.group(1)), float(match.group(3))
+
+    match = _VERB_ROUTE_RE.match(question)
+    if match is not None:
+        op, preposition = match.group(1).lower(), match.group(3).lower()
+        if preposition in _VERB_PREPOSITIONS[op]:
+            x, y = float(match.group(2)), float(match.group(4))
+            # "subtract X from Y" means Y - X
+            return (op, y, x) if op == "subtract" else (op, x, y)
+
+    match = _INFIX_ROUTE_RE.match(question)
+    if match is None:
+        return None
+    x, y = float(match.group(1)), float(match.group(3))
+    if match.group(2).lower() == "subtracted from":
+        return "subtract", y, x
+    return normalize_operation(match.group(2)), x, y
+
+
+def local_route(question: str, model_name: str) -> tuple[str, float, float] | None:
+    return directive_route(question) or regex_route(question) or cached_route(question, model_name)
+
 
+def cached_route(question: str, model_name: str) -> tuple[str, float, float] | None:
+    # Routing is deterministic (temperature=0), so a previous answer for the
+    # same question and model can be reused without calling the API. The
+    # in-process LRU answers repeats without touching SQLite.
+    memo_key = (model_name, normalize_question(question))
+    route = _memo_get(memo_key)
+    if route is not None:
+        return route
 
-def llm_route_question(question: str, model: str | None = None) -> tuple[str | None, float | None, float | None]:
+    cached = route_cache_get(route_cache_key(question, model_name))
+    if cached is not None:
+        op, a, b = cached
+        route = op, float(a), float(b)
+    else:
+        # Questions that only differ in their numbers share a template entry
+        # that records which slot feeds each operand.
+        template, slots = question_template(question)
+        cached = route_cache_get(route_cache_key(f"template|{template}", model_name))
+        if cached is None:
+            return None
+        op, a_slot, b_slot = cached
+        route = op, slots[a_slot], slots[b_slot]
+
+    _memo_put(memo_key, route)
+    return route
+
+
+def store_route(question: str, model_name: str, route: tuple[str | None, float | None, float | None]) -> None:
+    op, a, b = route
+    if not op or a is None or b is None:
+        return
+    _memo_put((model_name, normalize_question(question)), (op, a, b))
+    route_cache_put(route_cache_key(question, model_name), (op, a, b))
+    template, slots = question_template(question)
+    slot_route = template_route(op, a, b, template, slots)
+    if slot_route is not None:
+        route_cache_put(route_cache_key(f"template|{template}", model_name), slot_route)
+
+
+def route_request_body(question: str, model_name: str) -> dict:
+    return {
+        "model": model_name,
+        "messages": [
+            {"role": "system", "content": _ROUTE_SYSTEM_PROMPT},
+            {"role": "user", "content": question},
+        ],
+        "temperature": 0,
+        "tools": [_ROUTE_TOOL],
+        "tool_choice": {"type": "function", "function": {"name": "route"}},
+    }
+
+
+def parse_route_data(data: dict) -> tuple[str | None, float | None, float | None]:
+    a, b = data.get("a"), data.get("b")
+    return (
+        normalize_operation(data.get("operation")),
+        float(a) if a is not None else None,
+        float(b) if b is not None else None,
+    )
+
+
+async def llm_route_question(question: str, model: str | None = None) -> tuple[str | None, float | None, float | None]:
+    model_name = model or os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+
+    route = local_route(question, model_name)
+    if route is not None:
+        return route
+
+    # Identical questions routed concurrently share one in-flight request
+    # instead of each missing the cache and calling the API.
+    key = (model_name, normalize_question(question))
+    task = _IN_FLIGHT_ROUTES.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_llm_route_question(question, model_name))
+        _IN_FLIGHT_ROUTES[key] = task
+        task.add_done_callback(lambda _: _IN_FLIGHT_ROUTES.pop(key, None))
+    return await asyncio.shield(task)
+
+
+def _is_http2(stream) -> bool:
+    response = getattr(stream, "response", None)
+    return getattr(response, "http_version", None) == "HTTP/2"
+
+
+async def stream_tool_arguments(client, body: dict) -> str:
+    """Return the forced tool call's JSON arguments from a streamed completion.
+
+    Parsing stops as soon as the outer JSON object is complete. Over HTTP/2 the
+    stream is then closed without waiting for the trailing chunks; over
+    HTTP/1.1 closing a partly read response drops its connection, so the few
+    remaining chunks (finish reason and [DONE]) are drained instead and the
+    connection goes back to the keep-alive pool.
+    """
+    stream = await client.chat.completions.create(**body, stream=True)
+    buffer = ""
+    arguments = None
+    depth, in_string, escaped = 0, False, False
+    try:
+        async for chunk in stream:
+            if arguments is not None:
+                continue
+            if not chunk.choices or not chunk.choices[0].delta.tool_calls:
+                continue
+            function = chunk.choices[0].delta.tool_calls[0].function
+            text = (function.arguments if function is not None else None) or ""
+            start = len(buffer)
+            buffer += text
+            for offset, char in enumerate(text):
+                if escaped:
+                    escaped = False
+                elif in_string:
+                    if char == "\\":
+                        escaped = True
+                    elif char == '"':
+                        in_string = False
+                elif char == '"':
+                    in_string = True
+                elif char == "{":
+                    depth += 1
+                elif char == "}":
+                    depth -= 1
+                    if depth == 0:
+                        arguments = buffer[: start + offset + 1]
+                        break
+            if arguments is not None and _is_http2(stream):
+                return arguments
+    finally:
+        await stream.close()
+    return arguments if arguments is not None else buffer or "{}"
+
+
+async def _llm_route_question(question: str, model_name: str) -> tuple[str | None, float | None, float | None]:
     client = ensure_openai_client()
+
+    body = route_request_body(question, model_name)
+    try:
+        for _ in range(2):
+            # Chat Completions with a forced call to the strict "route" function
+            content = await stream_tool_arguments(client, body)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Route arguments: %s", content[:500])
+            try:
+                data = json_loads(content)
+            except json.JSONDecodeError:
+                # Ask once more instead of making the user retype the question
+                body["messages"].append(
+                    {"role": "user", "content": "Call route again with arguments that are valid JSON."}
+                )
+                continue
+            route = parse_route_data(data)
+            store_route(question, model_name, route)
+            return route
+    except Exception:
+        pass
+    return None, None, None
+
+
+def route_steps_request_body(question: str, model_name: str) -> dict:
+    return {
+        "model": model_name,
+        "messages": [
+            {"role": "system", "content": _ROUTE_STEPS_SYSTEM_PROMPT},
+            {"role": "user", "content": question},
+        ],
+        "temperature": 0,
+        "tools": [_ROUTE_STEPS_TOOL],
+        "tool_choice": {"type": "function", "function": {"name": "route_steps"}},
+    }
+
+
+async def llm_route_steps(question: str, model: str | None = None) -> list[dict]:
     model_name = model or os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+    client = ensure_openai_client()
+    try:
+        response = await client.chat.completions.create(**route_steps_request_body(question, model_name))
+        content = response.choices[0].message.tool_calls[0].function.arguments or "{}"
+        steps = json_loads(content).get("steps") or []
+        for step in steps:
+            step["operation"] = normalize_operation(step.get("operation"))
+    except Exception:
+        return []
+    return steps
 
-    system_prompt = (
-        "You are a precise math tool router. "
-        "Extract exactly one operation and two numeric operands from the user's prompt. "
-        "Allowed operations: add, subtract, multiply, divide. "
-        "Return ONLY a compact JSON object with keys operation (string), a (number), b (number). "
-        "If the instruction implies 'subtract X from Y', use a=Y, b=X. "
-        "If division by zero is implied, still return the numbers as-is."
-    )
 
-    user_prompt = f"User prompt: {question}"
+def route_many_request_body(questions: list[str], model_name: str) -> dict:
+    numbered = "\n".join(f"{index}. {question}" for index, question in enumerate(questions, start=1))
+    return {
+        "model": model_name,
+        "messages": [
+            {"role": "system", "content": _ROUTE_MANY_SYSTEM_PROMPT},
+            {"role": "user", "content": numbered},
+        ],
+        "temperature": 0,
+        "tools": [_ROUTE_MANY_TOOL],
+        "tool_choice": {"type": "function", "function": {"name": "route_many"}},
+    }
+
 
+async def _llm_route_chunk(
+    questions: list[str], model_name: str
+) -> dict[int, tuple[str | None, float | None, float | None]]:
+    client = ensure_openai_client()
     try:
-        # Using Chat Completions with JSON response
-        from openai import OpenAI  # type: ignore
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
-            temperature=0,
-            response_format={"type": "json_object"},
-        )
-        content = response.choices[0].message.content or "{}"
-        print(f"Content: {content}")
-        data = json.loads(content)
-        op = normalize_operation(data.get("operation"))
-        print(f"Operation: {op}")
-        a = float(data.get("a")) if data.get("a") is not None else None
-        b = float(data.get("b")) if data.get("b") is not None else None
-        return op, a, b
+        response = await client.chat.completions.create(**route_many_request_body(questions, model_name))
+        content = response.choices[0].message.tool_calls[0].function.arguments or "{}"
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Route arguments: %s", content[:500])
+        items = json_loads(content).get("routes") or []
     except Exception:
-        return None, None, None
+        return {}
+
+    routes = {}
+    for item in items if isinstance(items, list) else []:
+        # A model that ignores the strict schema can return malformed items;
+        # skip them so their questions are routed on their own.
+        try:
+            index, route = item.get("index"), parse_route_data(item)
+        except (AttributeError, TypeError, ValueError):
+            continue
+        if isinstance(index, int) and 1 <= index <= len(questions):
+            routes[index - 1] = route
+    return routes
+
+
+async def llm_route_questions(
+    questions: list[str], model: str | None = None
+) -> list[tuple[str | None, float | None, float | None]]:
+    """Route several questions, sharing one LLM request per chunk of questions.
+
+    The system prompt is sent once per ROUTE_BATCH_SIZE questions instead of
+    once per question; chunks are requested concurrently.
+    """
+    model_name = model or os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+    routes: list[tuple[str | None, float | None, float | None] | None] = [
+        local_route(question, model_name) for question in questions
+    ]
+    pending = [index for index, route in enumerate(routes) if route is None]
+
+    if len(pending) > 1:
+        chunks = [pending[i:i + ROUTE_BATCH_SIZE] for i in range(0, len(pending), ROUTE_BATCH_SIZE)]
+        results = await asyncio.gather(
+            *(_llm_route_chunk([questions[index] for index in chunk], model_name) for chunk in chunks)
+        )
+        for chunk, chunk_routes in zip(chunks, results):
+            for position, index in enumerate(chunk):
+                route = chunk_routes.get(position)
+                if route is not None and route[0] and route[1] is not None and route[2] is not None:
+                    routes[index] = route
+                    store_route(questions[index], model_name, route)
+
+    # Anything the combined answer missed (or a lone question) is routed alone
+    missing = [index for index in pending if routes[index] is None]
+    single = await asyncio.gather(*(llm_route_question(questions[index], model=model) for index in missing))
+    for index, route in zip(missing, single):
+        routes[index] = route
+    return routes
+
+
+async def route_questions_batch(
+    questions: list[str], model: str | None = None, poll_interval: float = 10.0
+) -> list[tuple[str | None, float | None, float | None]]:
+    """Route many questions with one OpenAI Batch API job.
+
+    Questions already in the route cache are answered locally; the rest are
+    uploaded as a single JSONL file and polled until the batch finishes.
+    """
+    model_name = model or os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+    routes: list[tuple[str | None, float | None, float | None]] = [(None, None, None)] * len(questions)
+
+    pending = []
+    for index, question in enumerate(questions):
+        route = local_route(question, model_name)
+        if route is not None:
+            routes[index] = route
+        else:
+            pending.append(index)
+    if not pending:
+        return routes
+
+    client = ensure_openai_client()
+    lines = [
+        json_dumps_bytes({
+            "custom_id": str(index),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": route_request_body(questions[index], model_name),
+        })
+        for index in pending
+    ]
+    batch_file = await client.files.create(file=("routes.jsonl", b"\n".join(lines)), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    while batch.status not in {"completed", "failed", "expired", "cancelled"}:
+        await asyncio.sleep(poll_interval)
+        batch = await client.batches.retrieve(batch.id)
+
+    if batch.status != "completed" or not batch.output_file_id:
+        return routes
+
+    output = await client.files.content(batch.output_file_id)
+    for line in output.text.splitlines():
+        try:
+            item = json_loads(line)
+            index = int(item["custom_id"])
+            message = item["response"]["body"]["choices"][0]["message"]
+            content = message["tool_calls"][0]["function"]["arguments"] or "{}"
+            routes[index] = parse_route_data(json_loads(content))
+        except Exception:
+            continue
+        store_route(questions[index], model_name, routes[index])
+    return routes
+
+
+async def call_route(session: ClientSession, route: tuple[str | None, float | None, float | None]) -> str:
+    operation, a, b = route
+    if operation and a is not None and b is not None:
+        return await call_tool(session, operation, a=a, b=b)
+    return "LLM could not parse the question. Please rephrase and try again."
+
+
+def _step_dependencies(step: dict) -> list[int]:
+    return [dep for dep in (step.get("a_step"), step.get("b_step")) if dep is not None]
+
+
+async def call_step(session: ClientSession, step: dict, results: dict[int, str]) -> str:
+    operands = []
+    for value, dep in ((step.get("a"), step.get("a_step")), (step.get("b"), step.get("b_step"))):
+        try:
+            operands.append(float(results[dep]) if dep is not None else float(value))
+        except (TypeError, ValueError):
+            return "Could not determine the operands for this step."
+    return await call_route(session, (step.get("operation"), operands[0], operands[1]))
+
+
+async def run_steps(session: ClientSession, steps: list[dict]) -> list[str]:
+    # Steps whose inputs are all known run together; dependent steps wait for
+    # the level that produces their operands.
+    results: dict[int, str] = {}
+    remaining = list(range(len(steps)))
+    while remaining:
+        ready = [i for i in remaining if all(dep in results for dep in _step_dependencies(steps[i]))]
+        if not ready:
+            break
+        texts = await asyncio.gather(*(call_step(session, steps[i], results) for i in ready))
+        results.update(zip(ready, texts))
+        remaining = [i for i in remaining if i not in results]
+    return [results.get(i, "Step refers to a step that could not run.") for i in range(len(steps))]
+
+
+async def handle_question(session: ClientSession, question: str, model: str | None = None) -> str:
+    return await call_route(session, await llm_route_question(question, model=model))
+
+
+async def handle_questions_file(session: ClientSession, path: str, model: str | None = None, batch: bool = False) -> None:
+    with open(path, encoding="utf-8") as fh:
+        questions = [line.strip() for line in fh if line.strip()]
+
+    if batch:
+        routes = await route_questions_batch(questions, model=model)
+    else:
+        routes = await llm_route_questions(questions, model=model)
+
+    results = await asyncio.gather(*(call_route(session, route) for route in routes))
+    for question, result in zip(questions, results):
+        print(f"{question} -> {result}")
+
+
+class MathMCPClient:
+    """Keeps one math server subprocess and MCP session open across questions.
+
+    The stdio transport is entered and exited by a dedicated owner task, so
+    connect() and disconnect() may be called from any task; concurrent
+    connect() calls share a single session.
+    """
+
+    def __init__(self, server_params: StdioServerParameters | None = None) -> None:
+        # Without explicit params, spawn the bundled math_mcp_server.py; a
+        # missing script raises FileNotFoundError here rather than on connect.
+        self.server_params = server_params or default_server_params()
+        self._lock = asyncio.Lock()
+        self._owner: asyncio.Task | None = None
+        self._closing: asyncio.Event | None = None
+        self._session: ClientSession | None = None
+
+    async def _own_session(self, ready: asyncio.Future, closing: asyncio.Event) -> None:
+        # anyio cancel scopes inside stdio_client must be exited by the task
+        # that entered them, so this task holds them until disconnect().
+        try:
+            async with stdio_client(self.server_params) as (read, write):
+                async with ClientSession(read, write) as session:
+                    await session.initialize()
+                    ready.set_result(session)
+                    await closing.wait()
+        except BaseException as exc:
+            if ready.done():
+                raise
+            ready.set_exception(exc)
+
+    async def connect(self) -> ClientSession:
+        async with self._lock:
+            if self._session is None:
+                ready = asyncio.get_running_loop().create_future()
+                closing = asyncio.Event()
+                owner = asyncio.create_task(self._own_session(ready, closing))
+                try:
+                    session = await ready
+                except BaseException:
+                    owner.cancel()
+                    await asyncio.gather(owner, return_exceptions=True)
+                    raise
+                self._owner, self._closing, self._session = owner, closing, session
+            return self._session
+
+    async def disconnect(self) -> None:
+        async with self._lock:
+            if self._owner is not None:
+                owner, closing = self._owner, self._closing
+                self._owner, self._closing, self._session = None, None, None
+                closing.set()
+                await owner
+
+    async def ask(self, question: str, model: str | None = None) -> str:
+        return await handle_question(await self.connect(), question, model=model)
+
+    async def __aenter__(self) -> "MathMCPClient":
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.disconnect()
+
+
+class LocalMathSession:
+    """Calls math_mcp_server's tool functions in-process instead of over stdio.
+
+    Exposes the same call_tool() shape as ClientSession, so routing and the
+    step runner work unchanged, without a subprocess or JSON-RPC framing.
+    """
+
+    def __init__(self, server_script: str | None = None) -> None:
+        if server_script is None:
+            server_script = get_server_script_path()
+        elif not os.path.exists(server_script):
+            raise FileNotFoundError(f"Server script not found at: {server_script}")
+        spec = importlib.util.spec_from_file_location("math_mcp_server", server_script)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        self._tools = {name: getattr(module, name) for name in OPERATIONS}
+
+    async def call_tool(self, name: str, arguments: dict | None = None, progress_callback=None) -> CallToolResult:
+        # Mirror the text FastMCP produces for results and tool errors; every
+        # tool takes float operands, which FastMCP would coerce to.
+        try:
+            operands = {key: float(value) for key, value in (arguments or {}).items()}
+            text, is_error = str(self._tools[name](**operands)), False
+        except KeyError:
+            text, is_error = f"Unknown tool: {name}", True
+        except Exception as exc:
+            text, is_error = f"Error executing tool {name}: {exc}", True
+        return CallToolResult(content=[TextContent(type="text", text=text)], isError=is_error)
+
+
+async def run_repl(session: ClientSession, model: str | None = None) -> None:
+    # Every question goes through the same server process and session. The
+    # prompt blocks in a worker thread so background tasks such as the OpenAI
+    # prewarm keep running while waiting for input.
+    while True:
+        try:
+            line = (await asyncio.to_thread(input, "math> ")).strip()
+        except EOFError:
+            break
+        if line.lower() in {"exit", "quit"}:
+            break
+        if line:
+            print(await handle_question(session, line, model=model))
 
 
 async def main() -> None:
     parser = argparse.ArgumentParser(description="MCP math client")
     parser.add_argument("--question", "-q", nargs="+", help="Natural language question, e.g. 'what is 3 plus 4'", required=False)
     parser.add_argument("--model", "-m", default=os.getenv("OPENAI_MODEL", "gpt-4o-mini"), help="LLM model name for agent mode")
+    parser.add_argument("--steps", action="store_true", help="Allow the -q question to chain several operations")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Log raw LLM routing responses to stderr")
+    parser.add_argument("--local", action="store_true", help="Call the server's tools in-process instead of spawning it over stdio")
+    parser.add_argument("--repl", action="store_true", help="Keep the server running and read questions from stdin")
+    parser.add_argument("--questions-file", help="Answer every question in a file, one per line")
+    parser.add_argument("--batch", action="store_true", help="Route --questions-file through the OpenAI Batch API (cheaper, asynchronous)")
     args = parser.parse_args()
 
-    server_script = get_server_script_path()
-    if not os.path.exists(server_script):
-        raise FileNotFoundError(f"Server script not found at: {server_script}")
+    if args.verbose:
+        logging.basicConfig(format="%(levelname)s %(name)s: %(message)s")
+        logger.setLevel(logging.DEBUG)
 
-    server_params = StdioServerParameters(
-        command=sys.executable,
-        args=[server_script],
-        env=None,
-    )
+    if not args.question and not args.repl and not args.questions_file:
+        print("Please provide a question with --question/-q, e.g. --question 'what is 3 plus 4', or use --questions-file/--repl")
+        sys.exit(1)
+
+    # Fail on a missing server script before starting any LLM work
+    server_script = get_server_script_path()
+    server_params = default_server_params()
 
-    async with stdio_client(server_params) as (read, write):
-        async with ClientSession(read, write) as session:
-            await session.initialize()
+    # Route the -q question concurrently with the server subprocess start, so
+    # the LLM round trip and the MCP handshake overlap.
+    route_task = None
+    if args.question:
+        router = llm_route_steps if args.steps else llm_route_question
+        route_task = asyncio.create_task(router(" ".join(args.question), model=args.model))
 
-            if not args.question:
-                print("Please provide a question with --question/-q, e.g. --question 'what is 3 plus 4'")
-                sys.exit(1)
+    # Without a -q question the first LLM call comes later (REPL input, a
+    # questions file); warm the OpenAI connection while the server starts.
+    prewarm_task = None
+    if route_task is None and os.getenv("OPENAI_API_KEY"):
+        prewarm_task = asyncio.create_task(prewarm_openai())
 
-            qtext = " ".join(args.question)
-            operation, a, b = llm_route_question(qtext, model=args.model)
+    async with AsyncExitStack() as stack:
+        if args.local:
+            session = LocalMathSession(server_script)
+        else:
+            client = await stack.enter_async_context(MathMCPClient(server_params))
+            session = await client.connect()
 
-            if operation and a is not None and b is not None:
-                result_text = await call_tool(session, operation, a=a, b=b)
-                print(result_text)
-            else:
+        if route_task is not None and args.steps:
+            steps = await route_task
+            if not steps:
                 print("LLM could not parse the question. Please rephrase and try again.")
+            for index, result in enumerate(await run_steps(session, steps), start=1):
+                print(f"Step {index}: {result}")
+        elif route_task is not None:
+            print(await call_route(session, await route_task))
 
+        if args.questions_file:
+            await handle_questions_file(session, args.questions_file, model=args.model, batch=args.batch)
 
-if __name__ == "__main__":
-    asyncio.run(main())
+        if args.repl:
+            await run_repl(session, model=args.model)
 
+    if prewarm_task is not None:
+        prewarm_task.cancel()
 
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,38 @@
+import pytest
+
+import math_mcp_client as m
+
+MODEL = "gpt-4o-mini"
+
+
+@pytest.fixture(autouse=True)
+def route_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(m, "ROUTE_CACHE_PATH", str(tmp_path / "routes.sqlite"))
+    m._open_route_cache.cache_clear()
+    m._ROUTE_MEMO.clear()
+    yield
+    m._open_route_cache.cache_clear()
+    m._ROUTE_MEMO.clear()
+
+
+@pytest.mark.parametrize(
+    "first, second",
+    [
+        ("what is the difference between 10 and 3", "what is the difference between 3 and 10"),
+        ("what is the difference between 3 and 10", "what is the difference between 10 and 3"),
+    ],
+)
+def test_value_ordered_subtract_is_not_templated(first, second):
+    m.store_route(first, MODEL, ("subtract", 10.0, 3.0))
+    assert m.local_route(first, MODEL) == ("subtract", 10.0, 3.0)
+    assert m.local_route(second, MODEL) is None
+
+
+def test_order_word_subtract_is_templated():
+    m.store_route("take 3 away from 10", MODEL, ("subtract", 10.0, 3.0))
+    assert m.local_route("take 5 away from 20", MODEL) == ("subtract", 20.0, 5.0)
+
+
+def test_commutative_route_is_templated():
+    m.store_route("how much is 3 and 4 together", MODEL, ("add", 3.0, 4.0))
+    assert m.local_route("how much is 10 and 2 together", MODEL) == ("add", 10.0, 2.0)